@@ -20,33 +20,148 @@
 
 import argparse
 import csv
+import heapq
+import struct
 import sys
+import tempfile
 from datetime import datetime
 
+# Rough in-memory size of one parsed transaction, for the sort memory budget
+TR_MEM_SIZE = 1024
+# Max number of sorted runs to merge at a time
+MERGE_FAN_IN = 64
+# Binary encoding of a transaction: sort sequence number, index, amount in
+# cents, date ordinal, length of name and length of reference
+TR_STRUCT = struct.Struct('<QiqIHH')
+
 
 def nda_str_decode(string):
     """Decode Scandic letters"""
     return string.replace('{', 'ä').replace('[', 'Ä').replace('\\', 'Ö')
 
 
-def parse_transactions(filepath):
-    """Parse transaction records out of a bank statement in NDA format"""
-    tr_list = []
+def new_transaction(index, cents, name, reference, date):
+    """Create a transaction record"""
+    amount = cents / 100.0
+    return {
+            'index': index,
+            'amount': amount,
+            'amount_str': comma_float(amount, ':.2f'),
+            'name': name,
+            'reference': reference,
+            'date': date,
+            }
+
+
+def iter_transactions(filepath):
+    """Iterate over transaction records of a bank statement in NDA format"""
     with open(filepath) as fobj:
-        for line in fobj.readlines():
+        for line in fobj:
             rec_type = line[1:6]
             if rec_type == '10188' and line[187] == ' ':
-                amount = float(line[87:106]) / 100
-                new_tr = {
-                        'index': int(line[6:12]),
-                        'amount': amount,
-                        'amount_str': comma_float(amount, ':.2f'),
-                        'name': nda_str_decode(line[108:143].strip()),
-                        'reference': line[160:180].strip().lstrip('0'),
-                        'date': datetime.strptime(line[30:36], '%y%m%d'),
-                        }
-                tr_list.append(new_tr)
-    return sorted(tr_list, key=lambda tr: tr['date'])
+                yield new_transaction(
+                        int(line[6:12]),
+                        int(line[87:106]),
+                        nda_str_decode(line[108:143].strip()),
+                        line[160:180].strip().lstrip('0'),
+                        datetime.strptime(line[30:36], '%y%m%d'))
+
+
+def str_encode(string):
+    """Encode string for a temporary file, no-op for Python 2 str"""
+    return string if isinstance(string, bytes) else string.encode('utf-8')
+
+
+def str_decode(data):
+    """Decode string read from a temporary file, no-op on Python 2"""
+    return data if isinstance(data, str) else data.decode('utf-8')
+
+
+def write_run(trs):
+    """Write sorted (seq, transaction) pairs into a temporary file"""
+    fobj = tempfile.TemporaryFile()
+    for seq, tra in trs:
+        name = str_encode(tra['name'])
+        reference = str_encode(tra['reference'])
+        cents = int(round(tra['amount'] * 100))
+        fobj.write(TR_STRUCT.pack(seq, tra['index'], cents,
+                                  tra['date'].toordinal(), len(name),
+                                  len(reference)))
+        fobj.write(name)
+        fobj.write(reference)
+    fobj.seek(0)
+    return fobj
+
+
+def read_run(fobj):
+    """Read (seq, transaction) pairs back from a temporary file"""
+    with fobj:
+        while True:
+            data = fobj.read(TR_STRUCT.size)
+            if not data:
+                return
+            seq, index, cents, date, name_len, ref_len = \
+                    TR_STRUCT.unpack(data)
+            name = str_decode(fobj.read(name_len))
+            reference = str_decode(fobj.read(ref_len))
+            yield seq, new_transaction(index, cents, name, reference,
+                                       datetime.fromordinal(date))
+
+
+def external_sort(trs, memory_budget, reverse=False):
+    """Sort transactions by date using temporary files
+
+    Transactions are sorted in chunks fitting in memory_budget (in bytes)
+    and the sorted runs are merged. The sort is stable, like sorted().
+    """
+    def sort_key(item):
+        """Sort by date, keeping the original order of equal dates"""
+        key = (item[1]['date'].toordinal(), item[0])
+        return (-key[0], -key[1]) if reverse else key
+
+    def merge(runs):
+        """Merge sorted runs into one stream of (seq, transaction) pairs"""
+        decorated = [((sort_key(item), item) for item in read_run(run))
+                     for run in runs]
+        for _, item in heapq.merge(*decorated):
+            yield item
+
+    chunk_size = max(1, memory_budget // TR_MEM_SIZE)
+    runs = []
+    chunk = []
+    for item in enumerate(trs):
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            runs.append(write_run(sorted(chunk, key=sort_key)))
+            chunk = []
+    if not runs:
+        # Everything fit in memory
+        for _, tra in sorted(chunk, key=sort_key):
+            yield tra
+        return
+    if chunk:
+        runs.append(write_run(sorted(chunk, key=sort_key)))
+    del chunk
+
+    # Merge runs until there are few enough to be merged in one pass
+    while len(runs) > MERGE_FAN_IN:
+        runs = [write_run(merge(runs[i:i + MERGE_FAN_IN]))
+                for i in range(0, len(runs), MERGE_FAN_IN)]
+    for _, tra in merge(runs):
+        yield tra
+
+
+def parse_transactions(filepath, reverse=False, memory_budget=None):
+    """Parse transaction records out of a bank statement in NDA format
+
+    Returns transactions sorted by date. If memory_budget (in bytes) is
+    given, sorting is done in bounded memory, using temporary files.
+    """
+    if memory_budget:
+        return external_sort(iter_transactions(filepath), memory_budget,
+                             reverse)
+    trs = sorted(iter_transactions(filepath), key=lambda tr: tr['date'])
+    return reversed(trs) if reverse else trs
 
 
 def parse_args(argv):
@@ -56,6 +171,9 @@ def parse_args(argv):
                         help='Simple human readable output of the transactions')
     parser.add_argument('-r', '--reverse', action='store_true',
                         help='Print transactions in reverse order')
+    parser.add_argument('-m', '--memory-budget', type=int, metavar='MIB',
+                        help='Sort transactions using temporary files and '
+                             'about %(metavar)s megabytes of memory')
     parser.add_argument('nda',
                         help='Nordea bank statement in NDA format')
     return parser.parse_args(argv[1:])
@@ -67,9 +185,9 @@ def main(argv=None):
     """Script entry point"""
     args = parse_args(argv)
 
-    trs = parse_transactions(args.nda)
-    if args.reverse:
-        trs = reversed(trs)
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget \
+            else None
+    trs = parse_transactions(args.nda, args.reverse, memory_budget)
 
     if args.human_readable:
         for tra in trs:
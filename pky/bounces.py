@@ -0,0 +1,357 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2015 Markus Lehtonen <knaeaepae@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Delivery status notification (bounce) handling"""
+import email.utils
+import mailbox
+import os
+import re
+import shelve
+from datetime import datetime, timedelta
+
+
+INDEX_FILENAME = 'bounces.txt'
+SENT_INDEX_FILENAME = 'sent'
+# Days after which a failed delivery is not taken into account anymore
+DEFAULT_EXPIRY_DAYS = 180
+# Same for delays and temporary failures, e.g. full mailbox
+TEMPORARY_EXPIRY_DAYS = 7
+
+
+def open_mailbox(path):
+    """Open a local mbox file or Maildir directory"""
+    if os.path.isdir(path):
+        return mailbox.Maildir(path, factory=None, create=False)
+    return mailbox.mbox(path, create=False)
+
+
+def iter_messages(path):
+    """Iterate over messages of a mailbox, one message at a time"""
+    mbox = open_mailbox(path)
+    try:
+        for key in mbox.iterkeys():
+            try:
+                yield mbox.get_message(key)
+            except KeyError:
+                # Message removed under our feet
+                continue
+    finally:
+        mbox.close()
+
+
+def xtext_encode(text):
+    """Encode text as SMTP xtext (RFC 3461)
+
+    >>> xtext_encode('a+b=c@d')
+    'a+2Bb+3Dc@d'
+    """
+    return ''.join([char if 33 <= ord(char) <= 126 and char not in '+='
+                        else '+%02X' % ord(char) for char in text])
+
+
+def xtext_decode(text):
+    """Decode SMTP xtext (RFC 3461)
+
+    >>> xtext_decode('a+2Bb+3Dc@d')
+    'a+b=c@d'
+    """
+    return re.sub(r'\+([0-9A-Fa-f]{2})',
+                  lambda match: chr(int(match.group(1), 16)), text)
+
+
+def _strip_addr_type(value):
+    """Strip address type from a DSN recipient field
+
+    >>> _strip_addr_type('rfc822; <Foo@Bar.com>')
+    'foo@bar.com'
+    """
+    value = value.split(';', 1)[-1].strip()
+    return value.strip('<>').lower()
+
+
+def _strip_msg_id(value):
+    """Normalize message id
+
+    >>> _strip_msg_id(' <123.pky@host>')
+    '123.pky@host'
+    """
+    return value.strip().strip('<>')
+
+
+def _returned_msg_id(msg):
+    """Get Message-ID of the original email returned in a DSN"""
+    for part in msg.walk():
+        content_type = part.get_content_type()
+        if content_type == 'message/rfc822':
+            orig = part.get_payload()[0]
+        elif content_type == 'text/rfc822-headers':
+            orig = email.message_from_string(part.get_payload(decode=True))
+        else:
+            continue
+        if orig.get('message-id'):
+            return _strip_msg_id(orig['message-id'])
+    return None
+
+
+def parse_dsn(msg):
+    """Parse delivery status notification
+
+    Returns a list of (action, recipient, status, message id) tuples, or an
+    empty list if the message is not a DSN. Message id is the envelope id,
+    or the Message-ID of the returned email, or None if neither is found.
+    """
+    if msg.get_content_type() != 'multipart/report':
+        return []
+    reports = []
+    for part in msg.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        blocks = part.get_payload()
+        # First block contains per-message fields, rest are per-recipient
+        envid = blocks[0].get('original-envelope-id') if blocks else None
+        if envid:
+            msg_id = _strip_msg_id(xtext_decode(envid))
+        else:
+            msg_id = _returned_msg_id(msg)
+        for fields in blocks[1:]:
+            rcpt = fields.get('final-recipient') or \
+                   fields.get('original-recipient')
+            action = fields.get('action')
+            if rcpt and action:
+                reports.append((action.strip().lower(),
+                                _strip_addr_type(rcpt),
+                                (fields.get('status') or '').strip(),
+                                msg_id))
+    return reports
+
+
+def parse_log_line(line):
+    """Parse one entry of a sender log file
+
+    >>> status, email_addr, fields = parse_log_line(
+    ...         'OK to foo@bar.com: nro: 12 selite: Maksu 1 summa: 5')
+    >>> status, email_addr, sorted(fields.items())[:2]
+    ('OK', 'foo@bar.com', [('nro', '12'), ('selite', 'Maksu 1')])
+    """
+    match = re.match(r'^(\S+) to (\S+?): (.*)$', line.rstrip('\n'))
+    if not match:
+        return None
+    status, email_addr, details = match.groups()
+    split = re.split(r'(?:^| )(\S+): ', details)
+    fields = dict(zip(split[1::2], split[2::2]))
+    return (status, email_addr, fields)
+
+
+def parse_log_filename(path):
+    """Get run time stamp, command and reminder flag from log file name
+
+    Command is None for old log files that don't record it.
+
+    >>> parse_log_filename('logs/2015-03-01-120000-invoice-reminder.log')
+    (datetime.datetime(2015, 3, 1, 12, 0), 'invoice', True)
+    >>> parse_log_filename('logs/2015-03-01-120000-dry-run.log')
+    (datetime.datetime(2015, 3, 1, 12, 0), None, False)
+    """
+    basename = os.path.basename(path)[:-len('.log')]
+    timestamp = datetime.strptime(basename[:17], '%Y-%m-%d-%H%M%S')
+    flags = basename[18:].split('-')
+    if flags[0] in ('', 'reminder', 'dry'):
+        command = None
+    else:
+        command = flags[0]
+    return timestamp, command, 'reminder' in flags
+
+
+def iter_log_files(log_dir):
+    """Iterate over non-dry-run log files in log dir, oldest first"""
+    for filename in sorted(os.listdir(log_dir)):
+        if filename.endswith('.log') and not \
+                filename.endswith('-dry-run.log'):
+            yield os.path.join(log_dir, filename)
+
+
+def is_temporary(status):
+    """Check if a DSN status code means a (likely) temporary failure
+
+    >>> is_temporary('4.4.1'), is_temporary('5.2.2'), is_temporary('5.1.1')
+    (True, True, False)
+    """
+    # X.2.2 is 'mailbox full'
+    return status.startswith('4.') or status.endswith('.2.2')
+
+
+def dsn_date(msg):
+    """Get the date of a DSN message, defaults to current time"""
+    date = msg.get('date')
+    parsed = email.utils.parsedate_tz(date) if date else None
+    if parsed:
+        return datetime.fromtimestamp(email.utils.mktime_tz(parsed))
+    return datetime.now()
+
+
+class SentIndex(object):
+    """Persistent index of successfully sent emails
+
+    Records log fields of sent emails by message id, and the time stamp and
+    log fields of the latest email sent to each recipient. Log files are
+    indexed incrementally, only entries written after the previous update
+    are read.
+    """
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.db = shelve.open(os.path.join(log_dir, SENT_INDEX_FILENAME))
+
+    @staticmethod
+    def _key(field, value):
+        """Database key"""
+        return (u'%s:%s' % (field, value)).encode('utf-8')
+
+    def _add(self, timestamp, email_addr, fields):
+        """Record one sent email"""
+        if 'message-id' in fields:
+            msg_id = _strip_msg_id(fields.pop('message-id'))
+            self.db[self._key('id', msg_id)] = fields
+        key = self._key('email', email_addr.lower())
+        old = self.db.get(key)
+        if not old or old[0] <= timestamp:
+            self.db[key] = (timestamp, fields)
+
+    def update_from_logs(self):
+        """Add log entries that have not been indexed yet"""
+        for path in iter_log_files(self.log_dir):
+            log_key = self._key('log', os.path.basename(path))
+            offset = self.db.get(log_key, 0)
+            if offset >= os.path.getsize(path):
+                continue
+            timestamp = parse_log_filename(path)[0]
+            with open(path) as fobj:
+                fobj.seek(offset)
+                for line in iter(fobj.readline, ''):
+                    if not line.endswith('\n'):
+                        # Incomplete line, log is still being written
+                        break
+                    offset += len(line)
+                    entry = parse_log_line(line.decode('utf-8'))
+                    if entry and entry[0] == 'OK':
+                        self._add(timestamp, entry[1], entry[2])
+            self.db[log_key] = offset
+        self.db.sync()
+
+    def by_id(self, msg_id):
+        """Get log fields of a sent email, None if not found"""
+        return self.db.get(self._key('id', msg_id))
+
+    def by_addr(self, email_addr):
+        """Get time stamp and log fields of the latest email sent to a
+        recipient, None if not found"""
+        return self.db.get(self._key('email', email_addr.lower()))
+
+    def close(self):
+        """Write changes to disk"""
+        self.db.close()
+
+
+class BounceIndex(object):
+    """Index of failed and delayed recipients
+
+    Failures expire after expiry_days, delays and temporary failures after
+    TEMPORARY_EXPIRY_DAYS.
+    """
+    def __init__(self, log_dir, expiry_days=DEFAULT_EXPIRY_DAYS):
+        self.path = os.path.join(log_dir, INDEX_FILENAME)
+        self.expiry = timedelta(days=expiry_days)
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(self.path):
+            with open(self.path) as fobj:
+                for lineno, line in enumerate(fobj, 1):
+                    entry = self._parse_line(line.decode('utf-8'))
+                    if entry:
+                        self.entries[entry[0]] = entry[1:]
+                    elif line.strip():
+                        print "WARNING: ignoring malformed line %d in " \
+                              "%s" % (lineno, self.path)
+
+    @staticmethod
+    def _parse_line(line):
+        """Parse one line of the index file"""
+        split = line.rstrip('\n').split(' ', 4)
+        if len(split) < 4:
+            return None
+        action, email_addr, status, date = split[:4]
+        try:
+            date = datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            return None
+        details = split[4] if len(split) > 4 else u''
+        return (email_addr, action, status, date, details)
+
+    def update(self, action, email_addr, status, date, details=u''):
+        """Update status of one recipient"""
+        email_addr = email_addr.lower()
+        old = self.entries.get(email_addr)
+        if old and old[2] > date:
+            # Already have a newer report
+            return
+        if action == 'delivered' or action == 'relayed':
+            self.clear(email_addr)
+        elif action == 'failed' or action == 'delayed':
+            # Don't let a later delay notification mask a failure
+            if action == 'delayed' and old and old[0] == 'failed' and \
+                    not self._expired(old):
+                return
+            self.entries[email_addr] = (action, status or '-', date, details)
+            self.changed = True
+
+    def clear(self, email_addr):
+        """Forget bounces of one recipient"""
+        if self.entries.pop(email_addr.lower(), None):
+            self.changed = True
+            return True
+        return False
+
+    def _expired(self, entry):
+        """Check if an index entry is too old to be taken into account"""
+        action, status, date = entry[:3]
+        if action == 'failed' and not is_temporary(status):
+            expiry = self.expiry
+        else:
+            expiry = timedelta(days=TEMPORARY_EXPIRY_DAYS)
+        return datetime.now() - date > expiry
+
+    def action(self, email_addr):
+        """Get the bounce action of a recipient, None if not bounced"""
+        entry = self.entries.get(email_addr.lower())
+        if not entry or self._expired(entry):
+            return None
+        return entry[0]
+
+    def save(self):
+        """Write index to disk"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fobj:
+            for email_addr, entry in sorted(self.entries.iteritems()):
+                if self._expired(entry):
+                    continue
+                action, status, date, details = entry
+                fobj.write((u'%s %s %s %s %s\n' %
+                            (action, email_addr, status,
+                             date.strftime('%Y-%m-%d'), details)
+                           ).encode('utf-8'))
+        os.rename(tmp_path, self.path)
+        self.changed = False
@@ -19,16 +19,22 @@
 """The 'invoice' command"""
 import os
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from .common import ask_value, std_date, CmdBase, EmailGroup
+from .common import ask_value, split_email_address, std_date, CmdBase, \
+        EmailGroup
+from .invoice_pdf import render_invoice_pdf
 
 
+PAYEE = {'payee': u'Polyteknikkojen Kuoron kannatusyhdistys ry',
+         'bank': u'Nordea',
+         'iban': u'FI14 1112 3000 3084 34'}
+
 DEFAULT_DETAILS_TEMPLATE = u"""
 Selite: %(selite)s
-Saaja: Polyteknikkojen Kuoron kannatusyhdistys ry
-Pankkiyhteys: Nordea
-Tilinumero: FI14 1112 3000 3084 34
+Saaja: """ + PAYEE['payee'] + u"""
+Pankkiyhteys: """ + PAYEE['bank'] + u"""
+Tilinumero: """ + PAYEE['iban'] + u"""
 Viitenumero: %(viitenro)s
 Summa: %(summa)s
 Eräpäivä: %(eräpäivä)s
@@ -44,6 +50,7 @@ Parhain terveisin,
 class CmdInvoice(CmdBase):
     """Functionality for 'invoice' command"""
     log_fields = ['nro', 'selite', 'summa', 'viitenro']
+    use_history = True
 
     @staticmethod
     def range_to_filter(range_str):
@@ -93,8 +100,35 @@ class CmdInvoice(CmdBase):
             # Mangle due dates
             for row in rows:
                 row[u'eräpäivä'] = 'HETI'
+
+        if self.history and not self.args.resend:
+            rows = self._skip_sent(rows)
         return rows
 
+    def _skip_sent(self, rows):
+        """Filter out invoices already sent, or reminded of recently"""
+        interval = timedelta(days=int(self.config.get('reminder-interval',
+                                                      14)))
+        now = datetime.now()
+        send_rows = []
+        for row in rows:
+            email_addr = split_email_address(row['email'])[1]
+            if self.args.reminder:
+                last = self.history.lookup('email', email_addr).get('reminded')
+                if last and now - last < interval:
+                    print "Skipping invoice %s, <%s> was reminded on %s" % \
+                            (row[u'nro'], email_addr,
+                             last.strftime('%d.%m.%Y'))
+                    continue
+            else:
+                last = self.history.lookup('nro', row[u'nro']).get('sent')
+                if last:
+                    print "Skipping invoice %s, already sent on %s" % \
+                            (row[u'nro'], last.strftime('%d.%m.%Y'))
+                    continue
+            send_rows.append(row)
+        return send_rows
+
     def group_data(self, rows):
         """Return grouped row data"""
         # Group data
@@ -149,3 +183,9 @@ class CmdInvoice(CmdBase):
         # Form message template
         return greeting_msg + u'\n' + msg_details + FOOTER
 
+    def get_attachments(self, rows):
+        """Get PDF invoices for rows"""
+        if not self.args.pdf:
+            return super(CmdInvoice, self).get_attachments(rows)
+        return [[('lasku-%s.pdf' % row[u'nro'],
+                  render_invoice_pdf(row, PAYEE))] for row in rows]
@@ -18,6 +18,8 @@
 #
 """Send mmessages from a csv file"""
 
+import re
+import string
 from datetime import datetime
 
 
@@ -33,10 +35,13 @@ class CmdBase(object):
     """Baseclass for commands"""
     name = None
     log_fields = None
+    # Record sent emails in the send history
+    use_history = False
 
     def __init__(self, args, config):
         self.args = args
         self.config = config
+        self.history = None
 
 
     @staticmethod
@@ -103,6 +108,10 @@ class CmdBase(object):
         """Get email message body template"""
         raise NotImplementedError()
 
+    def get_attachments(self, rows):
+        """Get list of (filename, data) attachments for each row"""
+        return [[] for _ in rows]
+
 
 def std_date(date_str):
     """Convert string to date"""
@@ -121,3 +130,29 @@ def ask_value(question, default=None, choices=None):
         elif default is not None:
             return default
 
+
+def split_email_address(text):
+    """Split name and address out of an email address
+
+    >>> split_email_address('foo@bar.com')
+    ('', 'foo@bar.com')
+    >>> split_email_address('Foo Bar foo@bar.com')
+    ('Foo Bar', 'foo@bar.com')
+    >>> split_email_address('  "Foo Bar" <foo@bar.com>, ')
+    ('Foo Bar', 'foo@bar.com')
+    """
+    split = text.strip().rsplit(None, 1)
+    email_re = r'.*?([^<%s]\S*@\S+[a-zA-Z])' % string.whitespace
+    match = re.match(email_re, split[-1])
+    if not match:
+        raise Exception("Invalid email address: '%s'" % text)
+    email_addr = match.group(1)
+
+    name = ''
+    if len(split) > 1:
+        non_letter = string.punctuation + string.whitespace
+        name_re = r'.*?([^%s].*[^%s])' % (non_letter, non_letter)
+        match = re.match(name_re, split[0])
+        if match:
+            name = match.group(1)
+    return (name, email_addr)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2015 Markus Lehtonen <knaeaepae@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Index of sent emails over all runs"""
+import os
+import shelve
+from datetime import datetime
+
+from .bounces import iter_log_files, parse_log_filename, parse_log_line
+from .cmd_invoice import CmdInvoice
+
+
+HISTORY_FILENAME = 'history'
+
+# Log fields that are indexed, in addition to the recipient
+INDEX_FIELDS = ['nro', 'viitenro']
+
+
+class SendHistory(object):
+    """Persistent index of successfully sent invoices
+
+    Records the time of the latest sent invoice and reminder, keyed by
+    recipient and by the INDEX_FIELDS. Emails sent by other commands are
+    not recorded.
+    """
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.reminder = False
+        self.db = shelve.open(os.path.join(log_dir, HISTORY_FILENAME))
+
+    @staticmethod
+    def _key(field, value):
+        """Database key"""
+        return (u'%s:%s' % (field, value)).lower().encode('utf-8')
+
+    def lookup(self, field, value):
+        """Get time stamps of the latest sent invoice and reminder"""
+        return self.db.get(self._key(field, value), {})
+
+    def add(self, timestamp, reminder, email_addr, fields):
+        """Record one sent email"""
+        kind = 'reminded' if reminder else 'sent'
+        keys = [self._key('email', email_addr)]
+        keys += [self._key(field, fields[field]) for field in INDEX_FIELDS
+                    if fields.get(field)]
+        for key in keys:
+            entry = self.db.get(key, {})
+            if entry.get(kind, datetime.min) < timestamp:
+                entry[kind] = timestamp
+                self.db[key] = entry
+
+    def add_current(self, email_addr, fields):
+        """Record one email sent in the current run"""
+        self.add(datetime.now(), self.reminder, email_addr, fields)
+
+    def start_run(self, log_path, reminder):
+        """Start recording a new run, writing to log_path"""
+        self.reminder = reminder
+        self.db[self._key('log', os.path.basename(log_path))] = True
+
+    @staticmethod
+    def _is_invoice_entry(entry):
+        """Check if a log entry of an old log file is from an invoice"""
+        fields = set(entry[2].keys()) - set(['message-id'])
+        return fields == set(CmdInvoice.log_fields)
+
+    def update_from_logs(self):
+        """Add entries from log files that have not been indexed yet"""
+        for path in iter_log_files(self.log_dir):
+            log_key = self._key('log', os.path.basename(path))
+            if log_key in self.db:
+                continue
+            timestamp, command, reminder = parse_log_filename(path)
+            if command is None or command == 'invoice':
+                with open(path) as fobj:
+                    for line in fobj:
+                        entry = parse_log_line(line.decode('utf-8'))
+                        if entry and entry[0] == 'OK' and \
+                                (command or self._is_invoice_entry(entry)):
+                            self.add(timestamp, reminder, entry[1], entry[2])
+            self.db[log_key] = True
+        self.db.sync()
+
+    def close(self):
+        """Write changes to disk"""
+        self.db.close()
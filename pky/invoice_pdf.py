@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2015 Markus Lehtonen <knaeaepae@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""PDF invoices with Finnish virtual barcode"""
+import re
+from datetime import datetime
+from decimal import Decimal
+
+
+# Static part of the page: (font, size, x, y, text)
+STATIC_LAYOUT = [
+    ('F2', 20, 60, 770, u'LASKU'),
+    ('F1', 10, 60, 700, u'Saaja'),
+    ('F1', 10, 60, 680, u'Tilinumero'),
+    ('F1', 10, 60, 660, u'Pankkiyhteys'),
+    ('F1', 10, 60, 620, u'Laskun numero'),
+    ('F1', 10, 60, 600, u'Selite'),
+    ('F1', 10, 60, 580, u'Viitenumero'),
+    ('F1', 10, 60, 560, u'Summa'),
+    ('F1', 10, 60, 540, u'Eräpäivä'),
+    ('F1', 10, 60, 480, u'Virtuaaliviivakoodi'),
+    ]
+
+# Per-invoice fields: (font, size, x, y, template)
+INVOICE_FIELDS = [
+    ('F1', 10, 180, 700, u'%(payee)s'),
+    ('F1', 10, 180, 680, u'%(iban)s'),
+    ('F1', 10, 180, 660, u'%(bank)s'),
+    ('F1', 10, 180, 620, u'%(nro)s'),
+    ('F1', 10, 180, 600, u'%(selite)s'),
+    ('F2', 10, 180, 580, u'%(viitenro)s'),
+    ('F2', 10, 180, 560, u'%(summa)s'),
+    ('F2', 10, 180, 540, u'%(eräpäivä)s'),
+    ('F1', 10, 60, 460, u'%(barcode)s'),
+    ]
+
+# Cached, pre-rendered static part of the PDF document (per process)
+_STATIC_PDF = None
+
+
+def _pdf_str(text):
+    """Encode text as a PDF string literal"""
+    text = text.encode('cp1252', 'replace')
+    return '(%s)' % text.replace('\\', '\\\\').replace('(', '\\(').\
+            replace(')', '\\)')
+
+
+def _text_ops(items):
+    """PDF content stream operators for placing text"""
+    ops = []
+    for font, size, x_pos, y_pos, text in items:
+        ops.append('BT /%s %d Tf %d %d Td %s Tj ET' %
+                   (font, size, x_pos, y_pos, _pdf_str(text)))
+    return '\n'.join(ops) + '\n'
+
+
+def _pdf_object(num, body):
+    """Serialize one indirect PDF object"""
+    return '%d 0 obj\n%s\nendobj\n' % (num, body)
+
+
+def _pdf_stream(num, data):
+    """Serialize one PDF stream object"""
+    return _pdf_object(num, '<< /Length %d >>\nstream\n%sendstream' %
+                            (len(data), data))
+
+
+def render_static_layout():
+    """Render the static part of the invoice PDF
+
+    Returns the document head (objects preceding the per-invoice content
+    stream), the byte offsets of its objects, for building the xref, and the
+    objects following the per-invoice content stream.
+    """
+    font = '<< /Type /Font /Subtype /Type1 /BaseFont /%s ' \
+           '/Encoding /WinAnsiEncoding >>'
+    objs = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+        '/Resources << /Font << /F1 6 0 R /F2 7 0 R >> >> '
+        '/Contents [4 0 R 5 0 R] >>',
+        ]
+    head = '%PDF-1.4\n'
+    offsets = []
+    for num, body in enumerate(objs, 1):
+        offsets.append(len(head))
+        head += _pdf_object(num, body)
+    offsets.append(len(head))
+    head += _pdf_stream(4, _text_ops(STATIC_LAYOUT))
+    # Object 5 is the per-invoice content stream, fonts come after it
+    tail = [_pdf_object(6, font % 'Helvetica'),
+            _pdf_object(7, font % 'Helvetica-Bold')]
+    return head, offsets, tail
+
+
+def parse_amount(text):
+    """Parse amount of money from a string
+
+    >>> parse_amount(u'25,50 €')
+    Decimal('25.50')
+    >>> parse_amount('1 200')
+    Decimal('1200')
+    >>> parse_amount(u'-5')
+    Decimal('-5')
+    >>> parse_amount(u'1,234.56')
+    Traceback (most recent call last):
+    ...
+    Exception: Invalid amount: '1,234.56'
+    """
+    number = re.sub(r'[^0-9,.-]', '', text)
+    if ',' in number and '.' in number:
+        # Ambiguous, don't guess which one is the decimal separator
+        raise Exception("Invalid amount: '%s'" % text)
+    number = number.replace(',', '.')
+    if not re.match(r'^-?(\d+(\.\d*)?|\.\d+)$', number):
+        raise Exception("Invalid amount: '%s'" % text)
+    return Decimal(number)
+
+
+def virtual_barcode(iban, amount, reference, due_date=None):
+    """Form a Finnish bank virtual barcode (virtuaaliviivakoodi)
+
+    >>> virtual_barcode('FI79 4405 2020 0360 82', Decimal('4883.15'),
+    ...                 '86851 62596 19897', datetime(2010, 6, 12).date())
+    '479440520200360820048831500000000868516259619897100612'
+    >>> virtual_barcode('FI02 5000 4640 0013 02', Decimal('693.80'),
+    ...                 'RF61 6987 5672 0839', datetime(2011, 7, 24).date())
+    '502500046400013020006938061000000000698756720839110724'
+    """
+    iban = iban.replace(' ', '').upper()
+    if not re.match(r'^FI\d{16}$', iban):
+        raise Exception("Invalid Finnish IBAN: '%s'" % iban)
+    reference = reference.replace(' ', '').upper()
+    if amount < 0 or amount >= 1000000:
+        # Amount does not fit in the barcode, payer fills it in
+        amount = Decimal(0)
+    euros = int(amount)
+    cents = int((amount - euros) * 100)
+    date_str = due_date.strftime('%y%m%d') if due_date else '000000'
+
+    if reference.startswith('RF'):
+        if not re.match(r'^RF\d{2}\d{1,21}$', reference):
+            raise Exception("Invalid reference: '%s'" % reference)
+        return '5%s%06d%02d%s%s%s' % (iban[2:], euros, cents, reference[2:4],
+                                      reference[4:].zfill(21), date_str)
+    else:
+        if not re.match(r'^\d{1,20}$', reference):
+            raise Exception("Invalid reference: '%s'" % reference)
+        return '4%s%06d%02d000%s%s' % (iban[2:], euros, cents,
+                                       reference.zfill(20), date_str)
+
+
+def render_invoice_pdf(row, payee):
+    """Render a single invoice PDF
+
+    Only the per-invoice fields are rendered here, the static layout
+    (rendered by render_static_layout()) is cached and re-used as-is.
+    """
+    global _STATIC_PDF
+    if _STATIC_PDF is None:
+        _STATIC_PDF = render_static_layout()
+    head, offsets, tail = _STATIC_PDF
+    try:
+        due_date = datetime.strptime(row[u'eräpäivä'], '%d.%m.%Y').date()
+    except ValueError:
+        # E.g. 'HETI' in reminders
+        due_date = None
+    fields = dict(row)
+    fields.update(payee)
+    fields[u'barcode'] = virtual_barcode(payee['iban'],
+                                         parse_amount(row[u'summa']),
+                                         row[u'viitenro'], due_date)
+    stamp = [(font, size, x_pos, y_pos, tmpl % fields) for
+                font, size, x_pos, y_pos, tmpl in INVOICE_FIELDS]
+
+    offsets = list(offsets)
+    pdf = head
+    offsets.append(len(pdf))
+    pdf += _pdf_stream(5, _text_ops(stamp))
+    for obj in tail:
+        offsets.append(len(pdf))
+        pdf += obj
+    xref_pos = len(pdf)
+    pdf += 'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1)
+    pdf += ''.join(['%010d 00000 n \n' % offset for offset in offsets])
+    pdf += 'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % \
+            (len(offsets) + 1, xref_pos)
+    return pdf
+
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2015 Markus Lehtonen <knaeaepae@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Collect failed and delayed recipients from bounced PKY emails"""
+
+import argparse
+import os
+import sys
+
+from pky.bounces import BounceIndex, SentIndex, dsn_date, iter_messages, \
+        parse_dsn
+from sender import parse_config
+
+
+def parse_args(argv):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--log-dir',
+                        help='Directory for log files')
+    parser.add_argument('--clear', action='append', default=[],
+                        metavar='EMAIL',
+                        help='Forget earlier bounces of %(metavar)s')
+    parser.add_argument('mailbox', nargs='*',
+                        help='Mbox file or Maildir directory containing '
+                             'delivery status notifications')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=None):
+    """Script entry point"""
+    args = parse_args(argv)
+    config = parse_config(os.path.dirname(argv[0]), 'bounces')
+
+    log_dir = args.log_dir if args.log_dir else config['log-dir']
+    log_dir = os.path.join(os.path.dirname(argv[0]), log_dir)
+    if not os.path.isdir(log_dir):
+        print "Log directory %s not found" % log_dir
+        return 1
+
+    sent = SentIndex(log_dir)
+    sent.update_from_logs()
+    index = BounceIndex(log_dir, int(config['bounce-expiry']))
+    for email_addr in args.clear:
+        if not index.clear(email_addr):
+            print "No bounces recorded for <%s>" % email_addr
+
+    num_msgs = num_reports = 0
+    for path in args.mailbox:
+        print "Reading %s..." % path
+        for msg in iter_messages(path):
+            num_msgs += 1
+            date = dsn_date(msg)
+            for action, email_addr, status, msg_id in parse_dsn(msg):
+                num_reports += 1
+                latest = sent.by_addr(email_addr)
+                if msg_id:
+                    fields = sent.by_id(msg_id)
+                    if fields is None:
+                        print "Unknown message %s to <%s> (%s), ignoring" % \
+                                (msg_id, email_addr, action)
+                        continue
+                elif latest:
+                    # No message id, assume the latest email sent
+                    fields = latest[1]
+                else:
+                    print "Unknown recipient <%s> (%s), ignoring" % \
+                            (email_addr, action)
+                    continue
+                if latest and latest[0] > date:
+                    print "Outdated report for <%s> (%s), ignoring" % \
+                            (email_addr, action)
+                    continue
+                details = ' '.join([u'%s: %s' % (key, val) for key, val in
+                                        sorted(fields.iteritems())])
+                index.update(action, email_addr, status, date, details)
+    index.save()
+    sent.close()
+
+    print "Processed %d delivery reports in %d messages" % (num_reports,
+                                                            num_msgs)
+    for email_addr, entry in sorted(index.entries.iteritems()):
+        if not index.action(email_addr):
+            # Expired
+            continue
+        print "%s <%s>: %s (%s)" % (entry[0].upper(), email_addr, entry[1],
+                                    entry[2].strftime('%d.%m.%Y'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -20,39 +20,381 @@
 
 import argparse
 import email.charset
+import email.utils
 import csv
+import multiprocessing
 import os
-import re
+import Queue
+import signal
 import smtplib
-import string
 import sys
+import threading
 from ConfigParser import ConfigParser
 from datetime import datetime
 from email.header import Header
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+from pky.bounces import BounceIndex, xtext_encode
 from pky.cmd_message import CmdMessage
 from pky.cmd_invoice import CmdInvoice
-from pky.common import ask_value, std_date
+from pky.common import ask_value, split_email_address, std_date
+from pky.history import SendHistory
 
 
-def write_log_entry(log_f, status, row_data, fields):
-    """Write entry to log file"""
+def write_log_entry(log_f, status, row_data, fields, history=None,
+                    msg_id=None):
+    """Write entry to log file, and sent emails to send history"""
     email_addr = split_email_address(row_data['email'])[1]
     details = ' '.join([u'%s: %s' % (field, row_data[field]) for
                 field in fields])
+    if msg_id:
+        details += u' message-id: %s' % msg_id
     log_f.write(('%s to %s: %s\n' %
                 (status, email_addr, details)).encode('utf-8'))
+    if history and status == 'OK':
+        history.add_current(email_addr, row_data)
 
 
-def compose_email(headers, message):
+def compose_email(headers, message, attachments=None):
     """Compose email text"""
     msg = MIMEText(message, _charset='utf-8')
+    if attachments:
+        text = msg
+        msg = MIMEMultipart()
+        msg.attach(text)
+        for filename, data in attachments:
+            part = MIMEApplication(data, 'pdf')
+            part.add_header('Content-Disposition', 'attachment',
+                            filename=filename)
+            msg.attach(part)
     for key, val in headers.iteritems():
         msg[key.capitalize()] = val
     return msg
 
 
+def compose_emails(cmd, rows, headers, message, rcpt_copies,
+                   attachments=None):
+    """Compose emails for rows
+
+    Returns (recipients, email text, message id) tuples.
+    """
+    if attachments is None:
+        attachments = cmd.get_attachments(rows)
+    emails = []
+    for row, row_attachments in zip(rows, attachments):
+        to_name, to_email = split_email_address(row['email'])
+        to_hdr = utf8_address_header((to_name, to_email))
+        msg_id = email.utils.make_msgid('pky')
+        msg = compose_email(dict(headers, to=to_hdr), message % row,
+                            row_attachments)
+        msg['Message-ID'] = msg_id
+        emails.append(([to_email] + rcpt_copies, msg.as_string(), msg_id))
+    return emails
+
+
+# Command object of a rendering worker process
+_WORKER_CMD = None
+
+
+def _init_render_worker(cmd):
+    """Initialize email rendering worker process"""
+    global _WORKER_CMD
+    _WORKER_CMD = cmd
+    # Let the main process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _render_batch(task):
+    """Compose a batch of emails in a worker process"""
+    rows, headers, message, rcpt_copies, attachments = task
+    return compose_emails(_WORKER_CMD, rows, headers, message, rcpt_copies,
+                          attachments)
+
+
+def _render_attachments(rows):
+    """Render attachments for a batch of rows in a worker process"""
+    return _WORKER_CMD.get_attachments(rows)
+
+
+def add_subject(example, messages, subject):
+    """Add Subject header to already composed emails
+
+    Used for subjects asked per group, after rendering the emails in
+    advance.
+    """
+    example['Subject'] = subject
+    subject_line = 'Subject: %s\n' % subject.encode()
+    return example, [(row, recipients, subject_line + msg, msg_id) for
+                        row, recipients, msg, msg_id in messages]
+
+
+class MessageRenderer(object):
+    """Compose emails in a pool of worker processes
+
+    The pool is started on first use. With only one process emails are
+    composed in the calling thread.
+    """
+    max_batch = 50
+
+    def __init__(self, cmd, processes):
+        self.cmd = cmd
+        self.processes = processes
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.closed = False
+
+    def _get_pool(self):
+        """Get the worker pool, starting it if needed"""
+        with self.pool_lock:
+            if self.closed:
+                raise Exception("Email renderer already shut down")
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes,
+                                                 _init_render_worker,
+                                                 (self.cmd,))
+            return self.pool
+
+    def _batches(self, rows):
+        """Split rows into batches for the worker processes"""
+        size = max(1, min(self.max_batch, len(rows) // (self.processes * 4)))
+        return [(i, rows[i:i + size]) for i in range(0, len(rows), size)]
+
+    def _submit(self, func, tasks):
+        """Queue tasks to the worker pool
+
+        Returns a function for collecting the results, in order.
+        """
+        result = self._get_pool().map_async(func, tasks, chunksize=1)
+        def collect():
+            """Wait for the results, without blocking KeyboardInterrupt"""
+            while True:
+                try:
+                    return [item for batch in result.get(timeout=0.1) for
+                                item in batch]
+                except multiprocessing.TimeoutError:
+                    pass
+        return collect
+
+    def render_attachments(self, group):
+        """Start rendering attachments of all emails of one group
+
+        Returns a function for collecting the attachments.
+        """
+        if self.processes == 1:
+            attachments = self.cmd.get_attachments(group.rows)
+            return lambda: attachments
+        return self._submit(_render_attachments,
+                            [batch for _, batch in self._batches(group.rows)])
+
+    def render_group(self, group, headers, message, rcpt_copies,
+                     attachments=None):
+        """Start composing all emails of one group
+
+        Returns a function for collecting an example email for showing to
+        the user and a list of (row, recipients, email text, message id)
+        tuples for sending. Attachments are rendered, too, unless given.
+        Work is only queued to the worker pool here so that several groups
+        can be rendered in parallel.
+        """
+        rows = group.rows
+        if attachments is None:
+            example_attachments = self.cmd.get_attachments(rows[:1])[0]
+        else:
+            example_attachments = attachments[0]
+        to_hdr = utf8_address_header(rows[0]['email'])
+        example = compose_email(dict(headers, to=to_hdr), message % rows[0],
+                                example_attachments)
+        if self.processes > 1:
+            tasks = [(batch, headers, message, rcpt_copies,
+                      attachments[i:i + len(batch)] if attachments else None)
+                     for i, batch in self._batches(rows)]
+            collect_emails = self._submit(_render_batch, tasks)
+        else:
+            emails = compose_emails(self.cmd, rows, headers, message,
+                                    rcpt_copies, attachments)
+            collect_emails = lambda: emails
+        return lambda: (example, [(row,) + email_data for row, email_data in
+                                    zip(rows, collect_emails())])
+
+    def close(self):
+        """Shut down the worker pool, after finishing pending work"""
+        with self.pool_lock:
+            self.closed = True
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def terminate(self):
+        """Shut down the worker pool, discarding pending work"""
+        with self.pool_lock:
+            self.closed = True
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+
+def _queue_get(queue):
+    """Get item from a queue, without blocking KeyboardInterrupt"""
+    while True:
+        try:
+            return queue.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+
+
+class GroupRenderer(threading.Thread):
+    """Render email groups in the background, in order
+
+    The render function starts rendering one group and returns a function
+    for collecting the result, so that rendering of the next groups proceeds
+    while the current one is being collected.
+    """
+    def __init__(self, groups, render, lookahead=2):
+        super(GroupRenderer, self).__init__()
+        self.daemon = True
+        self.groups = groups
+        self.render = render
+        self.queue = Queue.Queue(lookahead)
+        self.cancelled = threading.Event()
+
+    def run(self):
+        for group in self.groups:
+            try:
+                result = (self.render(group), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            while not self.cancelled.is_set():
+                try:
+                    self.queue.put(result, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if result[1] or self.cancelled.is_set():
+                return
+
+    def get(self):
+        """Get next rendered group"""
+        collect, exc_info = _queue_get(self.queue)
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return collect()
+
+    def cancel(self):
+        """Stop rendering"""
+        self.cancelled.set()
+
+
+class MailSender(threading.Thread):
+    """Send confirmed emails and write log entries in the background"""
+    def __init__(self, server, sender, dry_run, log_f, emails_f, log_fields,
+                 history=None):
+        super(MailSender, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.sender = sender
+        self.dry_run = dry_run
+        self.log_f = log_f
+        self.emails_f = emails_f
+        self.log_fields = log_fields
+        self.history = history
+        self.queue = Queue.Queue()
+        # Progress messages, printed by the main thread
+        self.status = Queue.Queue()
+        self.cancelled = threading.Event()
+        self.exc_info = None
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            status, messages = job
+            for row, recipients, msg, msg_id in messages:
+                if status == 'SKIPPED':
+                    write_log_entry(self.log_f, status, row, self.log_fields)
+                    continue
+                elif self.cancelled.is_set():
+                    write_log_entry(self.log_f, 'CANCELLED', row,
+                                    self.log_fields)
+                    continue
+                try:
+                    self._send(row, recipients, msg, msg_id)
+                except Exception:
+                    self.exc_info = sys.exc_info()
+                    self.cancelled.set()
+                    write_log_entry(self.log_f, 'FAILED', row,
+                                    self.log_fields)
+            self.log_f.flush()
+            self.emails_f.flush()
+
+    def _send(self, row, recipients, msg, msg_id):
+        """Send one email"""
+        if not self.dry_run:
+            self.status.put("Sending email to <%s>..." % recipients[0])
+            self.server.ehlo_or_helo_if_needed()
+            if self.server.has_extn('dsn'):
+                # For matching delivery status notifications to the email
+                mail_options = ['ENVID=' + xtext_encode(msg_id.strip('<>'))]
+            else:
+                mail_options = []
+            rsp = self.server.sendmail(self.sender, recipients, msg,
+                                       mail_options,
+                                       rcpt_options=['NOTIFY=FAILURE,DELAY'])
+        else:
+            self.status.put("Would send email to <%s>..." % recipients[0])
+            rsp = 0
+        if rsp:
+            write_log_entry(self.log_f, 'FAILED', row, self.log_fields)
+            self.status.put("Mail delivery failed: %s" % rsp)
+        else:
+            write_log_entry(self.log_f, 'OK', row, self.log_fields,
+                            self.history, msg_id)
+            self.emails_f.write('-'*79 + '\n')
+            self.emails_f.write(msg)
+            self.emails_f.write('\n')
+
+    def send(self, messages):
+        """Queue rendered emails for sending"""
+        self.queue.put(('OK', messages))
+
+    def skip(self, rows):
+        """Queue log entries of unsent emails"""
+        self.queue.put(('SKIPPED', [(row, None, None, None) for
+                                        row in rows]))
+
+    def cancel(self):
+        """Do not send any more emails, only log them as cancelled"""
+        self.cancelled.set()
+
+    def report(self):
+        """Print progress messages of the emails handled so far"""
+        while True:
+            try:
+                print self.status.get_nowait()
+            except Queue.Empty:
+                return
+
+    def check(self):
+        """Re-raise error that occurred in sending"""
+        if self.exc_info:
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def finish(self):
+        """Wait until all queued emails have been handled"""
+        self.queue.put(None)
+        while self.is_alive():
+            try:
+                self.join(0.1)
+            except KeyboardInterrupt:
+                print "\nInterrupted, cancelling..."
+                self.cancelled.set()
+
+
 def pprint_email(msg):
     """Pretty print email"""
     for key, val in msg.items():
@@ -61,7 +403,13 @@ def pprint_email(msg):
                                'content-transfer-encoding']:
             print '%s: %s' % (key, unicode(val))
     print ""
-    print msg.get_payload(decode=True)
+    if msg.is_multipart():
+        parts = msg.get_payload()
+        print parts[0].get_payload(decode=True)
+        for part in parts[1:]:
+            print "[Attachment: %s]" % part.get_filename()
+    else:
+        print msg.get_payload(decode=True)
 
 
 def utf8_reader(input_stream, dialect=None):
@@ -79,10 +427,10 @@ def to_u(text):
         return unicode(text)
 
 
-def utf8_header(text):
+def utf8_header(text, header_name=None):
     """Email header wih UTF-8 encoding"""
     # Convert text to unicode (assume we're using UTF-8)
-    return Header(to_u(text), 'utf-8')
+    return Header(to_u(text), 'utf-8', header_name=header_name)
 
 
 def utf8_address_header(addr):
@@ -106,31 +454,19 @@ def utf8_address_header(addr):
     return header
 
 
-def split_email_address(text):
-    """Split name and address out of an email address
-
-    >>> split_email_address('foo@bar.com')
-    ('', 'foo@bar.com')
-    >>> split_email_address('Foo Bar foo@bar.com')
-    ('Foo Bar', 'foo@bar.com')
-    >>> split_email_address('  "Foo Bar" <foo@bar.com>, ')
-    ('Foo Bar', 'foo@bar.com')
-    """
-    split = text.strip().rsplit(None, 1)
-    email_re = r'.*?([^<%s]\S*@\S+[a-zA-Z])' % string.whitespace
-    match = re.match(email_re, split[-1])
-    if not match:
-        raise Exception("Invalid email address: '%s'" % text)
-    email_addr = match.group(1)
-
-    name = ''
-    if len(split) > 1:
-        non_letter = string.punctuation + string.whitespace
-        name_re = r'.*?([^%s].*[^%s])' % (non_letter, non_letter)
-        match = re.match(name_re, split[0])
-        if match:
-            name = match.group(1)
-    return (name, email_addr)
+def skip_bounced(rows, bounces):
+    """Filter out rows whose recipient address has bounced"""
+    send_rows = []
+    for row in rows:
+        email_addr = split_email_address(row['email'])[1]
+        action = bounces.action(email_addr)
+        if action == 'failed':
+            print "Skipping <%s>, earlier delivery failed" % email_addr
+            continue
+        elif action == 'delayed':
+            print "WARNING: earlier delivery to <%s> was delayed" % email_addr
+        send_rows.append(row)
+    return send_rows
 
 
 def parse_config(path, command):
@@ -138,7 +474,8 @@ def parse_config(path, command):
     defaults = {'smtp-server': '',
                 'from': '',
                 'subject-prefix': '',
-                'log-dir': 'logs'}
+                'log-dir': 'logs',
+                'bounce-expiry': '180'}
     parser = ConfigParser(defaults)
     parser.add_section(command)
 
@@ -153,6 +490,14 @@ def parse_config(path, command):
     return dict(parser.items(command))
 
 
+def positive_int(text):
+    """Convert string to a positive integer"""
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: '%s'" % text)
+    return value
+
+
 def parse_args(argv):
     """Parse command line arguments"""
     main_parser = argparse.ArgumentParser()
@@ -174,6 +519,14 @@ def parse_args(argv):
                         help="Messgae subject, used for all emails")
     parser.add_argument('--subject-prefix', metavar='PREFIX',
                         help='Prefix all email subjects with %(metavar)s')
+    parser.add_argument('-j', '--jobs', type=positive_int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of worker processes for composing '
+                             'emails, defaults to the number of CPUs '
+                             '(%(default)s)')
+    parser.add_argument('--ignore-bounces', action='store_true',
+                        help='Send also to recipients whose earlier delivery '
+                             'failed')
     parser.add_argument('-F', '--filter-by', metavar='KEY',
                         help='Filter messages by this KEY')
     parser.add_argument('-f', '--filter-value', action='append',
@@ -192,6 +545,11 @@ def parse_args(argv):
                         help='Invoice details template')
     parser.add_argument('-r', '--reminder', action='store_true',
                         help='Only send invoices whose due date has passed')
+    parser.add_argument('--resend', action='store_true',
+                        help='Send also invoices that have already been sent, '
+                             'or reminded of recently')
+    parser.add_argument('--pdf', action='store_true',
+                        help='Attach invoices as PDF with a virtual barcode')
     parser.add_argument('-G', '--group-by', metavar='KEY', default='viite',
                         help='Mass-send invoices with the same value of KEY')
     group = parser.add_mutually_exclusive_group()
@@ -223,6 +581,8 @@ def main(argv=None):
     # Change email header encoding to QP for easier readability of raw data
     email.charset.add_charset('utf-8', email.charset.QP, email.charset.QP)
 
+    msg_renderer = MessageRenderer(cmd, args.jobs)
+
     with open(args.csv, 'r') as fobj:
         dialect = csv.Sniffer().sniff(fobj.read(512))
         fobj.seek(0)
@@ -235,10 +595,28 @@ def main(argv=None):
         for row in reader:
             all_data.append(dict(zip([val.lower() for val in header_row], row)))
 
+    log_dir = args.log_dir if args.log_dir else config['log-dir']
+    log_dir = os.path.join(os.path.dirname(argv[0]), log_dir)
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    if cmd.use_history:
+        history = SendHistory(log_dir)
+        history.update_from_logs()
+        cmd.history = history
+    else:
+        history = None
+
     send_data = cmd.filter_data(all_data)
+    if not args.ignore_bounces:
+        bounces = BounceIndex(log_dir, int(config['bounce-expiry']))
+        send_data = skip_bounced(send_data, bounces)
 
     if not send_data:
         print "No messages to send, exiting"
+        msg_renderer.close()
+        if history:
+            history.close()
         return 0
 
     # Get SMTP server
@@ -261,47 +639,82 @@ def main(argv=None):
     subject_prefix = cmd.subject_prefix()
 
     # Open initialize log files
-    log_dir = args.log_dir if args.log_dir else config['log-dir']
-    log_dir = os.path.join(os.path.dirname(argv[0]), log_dir)
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    log_f_basename = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+    reminder = getattr(args, 'reminder', False)
+    log_f_basename = datetime.now().strftime('%Y-%m-%d-%H%M%S') + '-' + \
+            args.cmd_name
+    if reminder:
+        log_f_basename += '-reminder'
     if args.dry_run:
         log_f_basename += '-dry-run'
-    log_f = open(os.path.join(log_dir, log_f_basename + '.log'), 'w')
+    log_path = os.path.join(log_dir, log_f_basename + '.log')
+    log_f = open(log_path, 'w')
+    if args.dry_run and history:
+        history.close()
+        history = None
+    elif history:
+        history.start_run(log_path, reminder)
     log_fields = cmd.log_fields or headers[0:3]
     emails_f = open(os.path.join(log_dir, log_f_basename + '-emails.txt'), 'w')
 
+    mail_sender = MailSender(server, sender[1], args.dry_run, log_f,
+                             emails_f, log_fields, history)
+    mail_sender.start()
+    renderer = None
     try:
         groups = cmd.group_data(send_data)
 
+        # Common email headers
+        headers = {'from': utf8_address_header(sender)}
+        if args.cc:
+            headers['cc'] = utf8_address_header(args.cc)
+        if args.bcc:
+            headers['bcc'] = utf8_address_header(args.bcc)
+        if args.subject:
+            headers['subject'] = utf8_header(subject_prefix + args.subject,
+                                             'Subject')
+        rcpt_copies = [cc[1] for cc in args.cc] + [bcc[1] for bcc in args.bcc]
+
+        # Render groups in the background, Subject is added afterwards if
+        # asked per group. If the message is asked per group only
+        # attachments can be rendered.
+        if args.message:
+            message = cmd.get_message()
+            renderer = GroupRenderer(groups,
+                                     lambda group: msg_renderer.render_group(
+                                         group, headers, message,
+                                         rcpt_copies))
+        else:
+            message = None
+            renderer = GroupRenderer(groups, msg_renderer.render_attachments)
+        renderer.start()
+
         # Send grouped emails
         for group in groups:
             rows = group.rows
+            mail_sender.report()
             if group.info_header:
                 print "\n==== " + group.info_header + " " + \
                         "="*(76-5-len(group.info_header))
                 print group.info_msg
 
-            # Email headers
-            headers = {'from': utf8_address_header(sender)}
-
-            if args.subject:
-                headers['subject'] = utf8_header(subject_prefix + args.subject)
+            group_headers = dict(headers)
+            if not args.subject:
+                group_headers['subject'] = utf8_header(subject_prefix +
+                                                       ask_value('Subject'),
+                                                       'Subject')
+            rendered = renderer.get()
+            if message is None:
+                example, messages = msg_renderer.render_group(
+                                            group, group_headers,
+                                            cmd.get_message(), rcpt_copies,
+                                            rendered)()
             else:
-                headers['subject'] = utf8_header(subject_prefix +
-                                                 ask_value('Subject'))
-            if args.cc:
-                headers['cc'] = utf8_address_header(args.cc)
-            if args.bcc:
-                headers['bcc'] = utf8_address_header(args.bcc)
-
-            # Get message body
-            message = cmd.get_message()
+                example, messages = rendered
+                if not args.subject:
+                    example, messages = add_subject(example, messages,
+                                                    group_headers['subject'])
 
             # Ask for confirmation
-            headers['to'] = utf8_address_header(rows[0]['email'])
-            example = compose_email(headers, message % rows[0])
             print '\n' + '-' * 79
             pprint_email(example)
             print '-' * 79 + '\n'
@@ -311,39 +724,32 @@ def main(argv=None):
                             "(%s)" % (len(recipients), ', '.join(recipients)),
                             choices=['n', 'y'])
             if proceed == 'y':
-                for row in rows:
-                    to_name, to_email = split_email_address(row['email'])
-                    recipients = [to_email] + \
-                                 [cc[1] for cc in args.cc] + \
-                                 [bcc[1] for bcc in args.bcc]
-                    headers['to'] = utf8_address_header((to_name, to_email))
-                    msg = compose_email(headers, message % row)
-
-                    if not args.dry_run:
-                        print "Sending email to <%s>..." % recipients[0]
-                        rsp = server.sendmail(sender[1],
-                                        recipients, msg.as_string(),
-                                        rcpt_options=['NOTIFY=FAILURE,DELAY'])
-                    else:
-                        print "Would send email to <%s>..." % recipients[0]
-                        rsp = 0
-                    if rsp:
-                        write_log_entry(log_f, 'FAILED', row, log_fields)
-                        print "Mail delivery failed: %s" % rsp
-                    else:
-                        write_log_entry(log_f, 'OK', row, log_fields)
-                        emails_f.write('-'*79 + '\n')
-                        emails_f.write(msg.as_string())
-                        emails_f.write('\n')
+                mail_sender.send(messages)
             else:
                 print "Did not send!"
-                for row in rows:
-                    write_log_entry(log_f, 'SKIPPED', row, log_fields)
-
+                mail_sender.skip(rows)
+            mail_sender.check()
+
+    except KeyboardInterrupt:
+        print "\nInterrupted, cancelling..."
+        msg_renderer.terminate()
+        mail_sender.cancel()
+        return 1
+    except Exception:
+        msg_renderer.terminate()
+        raise
     finally:
+        if renderer:
+            renderer.cancel()
+        mail_sender.finish()
+        mail_sender.report()
+        msg_renderer.close()
         server.quit()
         log_f.close()
         emails_f.close()
+        if history:
+            history.close()
+    mail_sender.check()
 
     return 0
 